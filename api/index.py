@@ -2,32 +2,127 @@ from flask import Flask, request, send_file, jsonify
 from flask_cors import CORS
 import tempfile
 import os
+import time
 from pathlib import Path
 import logging
 from werkzeug.utils import secure_filename
-from PIL import Image
+from werkzeug.exceptions import RequestEntityTooLarge
+from PIL import Image, features
 import zipfile
 import math
+import io
+import queue
+import atexit
+import shutil
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# 以下依赖都带原生库，加载失败时只关闭对应的功能，不影响其他压缩
+# pikepdf可选，未安装时PDF按原样复制
+try:
+    import pikepdf
+except (ImportError, OSError):
+    pikepdf = None
+
+# pypdfium2和img2pdf用于PDF图片转换压缩，缺少时跳过这一步
+try:
+    import pypdfium2 as pdfium
+except (ImportError, OSError):
+    pdfium = None
+
+try:
+    import img2pdf
+except (ImportError, OSError):
+    img2pdf = None
+
+# oxipng可选，用于PNG的并行滤波搜索和libdeflate重压缩
+try:
+    import oxipng
+except (ImportError, OSError):
+    oxipng = None
+
+# jpegli在同等质量下比libjpeg-turbo小15-20%，极限压缩时优先使用
+CJPEGLI = shutil.which('cjpegli')
 
 app = Flask(__name__)
 CORS(app, origins="*")  # 允许所有来源
 
+MAX_FILE_SIZE = 50 * 1024 * 1024  # 最大上传50MB
+COPY_CHUNK_SIZE = 1 << 20         # 上传按1MB分块写入
+
+# 由Werkzeug在解析表单时限制请求体大小，超过即中止读取
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+
 # 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志级别由LOG_LEVEL环境变量设置，生产环境可设为WARNING；无效值回退为INFO
+LOG_LEVEL = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO').upper())
+if not isinstance(LOG_LEVEL, int):
+    LOG_LEVEL = logging.INFO
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+# 检查Pillow是否链接了libjpeg-turbo（JPEG编码速度快2-6倍）
+if features.check_feature('libjpeg_turbo'):
+    logger.info('JPEG编码器: libjpeg-turbo')
+else:
+    logger.warning('JPEG编码器: 标准libjpeg，建议使用libjpeg-turbo构建Pillow')
+
+# 可复用的临时目录池，避免每个请求都创建并删除目录
+_TMP_POOL_ROOT = tempfile.mkdtemp(prefix='compress-')
+_TMP_POOL = queue.LifoQueue()
+atexit.register(shutil.rmtree, _TMP_POOL_ROOT, ignore_errors=True)  # 进程退出时删除整个池
+
+@contextmanager
+def pooled_tmp_dir():
+    """从池中取一个临时目录，用完清空内容后放回池中"""
+    try:
+        tmp_dir = _TMP_POOL.get_nowait()
+        os.makedirs(tmp_dir, exist_ok=True)  # 目录可能已被外部删除
+    except queue.Empty:
+        os.makedirs(_TMP_POOL_ROOT, exist_ok=True)  # 根目录也可能已被清理
+        tmp_dir = tempfile.mkdtemp(dir=_TMP_POOL_ROOT)
+    try:
+        yield tmp_dir
+    finally:
+        # 清理失败只记录日志，不影响已经完成的响应，目录仍放回池中
+        try:
+            with os.scandir(tmp_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            shutil.rmtree(entry.path)
+                        else:
+                            os.unlink(entry.path)
+                    except OSError as e:
+                        logger.warning('清理临时文件失败: %s', e)
+        except OSError as e:
+            logger.warning('清理临时目录失败: %s', e)
+        _TMP_POOL.put(tmp_dir)
+
+def save_upload(file, path):
+    """流式保存上传文件，返回写入的字节数"""
+    written = 0
+    with open(path, 'wb') as out:
+        while True:
+            chunk = file.stream.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            out.write(chunk)
+    return written
+
 def get_timestamp():
-    import time
     return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
 
 def format_file_size(bytes):
     """格式化文件大小"""
-    if bytes == 0:
+    if bytes <= 0:
         return "0 Bytes"
-    k = 1024
-    sizes = ["Bytes", "KB", "MB", "GB"]
-    i = int(math.floor(math.log(bytes) / math.log(k)))
-    return f"{bytes / math.pow(k, i):.2f} {sizes[i]}"
+    sizes = ("Bytes", "KB", "MB", "GB", "TB")
+    # 每个单位相差2**10，用位长度代替对数计算
+    i = min((int(bytes).bit_length() - 1) // 10, len(sizes) - 1)
+    return f"{bytes / (1 << (i * 10)):.2f} {sizes[i]}"
 
 @app.route('/')
 def home():
@@ -58,37 +153,29 @@ def compress_file():
         target_size = int(request.form.get('target_size', 1))  # MB
         mode = request.form.get('mode', 'size')
         
-        logger.info(f'开始极限压缩: {file.filename}, 级别: {level}')
+        logger.info('开始极限压缩: %s, 级别: %s', file.filename, level)
         
-        # 创建临时目录
-        with tempfile.TemporaryDirectory() as tmp_dir:
+        # 从池中取临时目录
+        with pooled_tmp_dir() as tmp_dir:
             # 保存上传的文件
             original_filename = secure_filename(file.filename)
             input_path = os.path.join(tmp_dir, original_filename)
-            file.save(input_path)
+            original_size = save_upload(file, input_path)
             
-            original_size = os.path.getsize(input_path)
-            logger.info(f'原始大小: {format_file_size(original_size)}')
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('原始大小: %s', format_file_size(original_size))
             
             # 根据文件类型选择压缩方法
-            file_ext = Path(input_path).suffix.lower()
+            output_path = compress_based_on_type(input_path, level, target_size, tmp_dir)
             
-            if file_ext == '.pdf':
-                output_path = compress_pdf_extreme(input_path, level, target_size, tmp_dir)
-            elif file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-                output_path = compress_image_extreme(input_path, level, target_size, tmp_dir)
-            elif file_ext in ['.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx']:
-                output_path = compress_document_extreme(input_path, level, target_size, tmp_dir)
-            else:
-                output_path = compress_generic_extreme(input_path, level, target_size, tmp_dir)
-            
-            # 获取压缩后大小
-            compressed_size = os.path.getsize(output_path)
-            compression_ratio = (1 - compressed_size / original_size) * 100
-            
-            logger.info(f'✅ 压缩完成!')
-            logger.info(f'压缩后大小: {format_file_size(compressed_size)}')
-            logger.info(f'压缩率: {compression_ratio:.1f}%')
+            # 压缩后大小和压缩率只用于日志，日志关闭时不计算
+            if logger.isEnabledFor(logging.INFO):
+                compressed_size = os.path.getsize(output_path)
+                compression_ratio = (1 - compressed_size / original_size) * 100
+                
+                logger.info('✅ 压缩完成!')
+                logger.info('压缩后大小: %s', format_file_size(compressed_size))
+                logger.info('压缩率: %.1f%%', compression_ratio)
             
             # 返回压缩后的文件
             return send_file(
@@ -98,35 +185,35 @@ def compress_file():
                 mimetype='application/octet-stream'
             )
             
+    except RequestEntityTooLarge:
+        return jsonify({'error': '文件过大，最大50MB'}), 413
     except Exception as e:
-        logger.error(f'压缩失败: {str(e)}', exc_info=True)
+        logger.error('压缩失败: %s', e, exc_info=True)
         return jsonify({'error': f'压缩失败: {str(e)}'}), 500
 
 def compress_pdf_extreme(file_path, level, target_size_mb, tmp_dir):
     """PDF极限压缩"""
     output_path = os.path.join(tmp_dir, 'compressed.pdf')
     
+    # 已经小于目标大小时无需重写（极限模式仍尽量压缩）
+    if target_size_mb > 0 and level != 'extreme' and os.path.getsize(file_path) <= target_size_mb * 1024 * 1024:
+        shutil.copy2(file_path, output_path)
+        logger.info('PDF已小于目标大小，跳过压缩')
+        return output_path
+    
     try:
-        # 方法1：尝试使用PyPDF2
-        try:
-            from PyPDF2 import PdfReader, PdfWriter
-            
-            reader = PdfReader(file_path)
-            writer = PdfWriter()
-            
-            # 复制所有页面
-            for page in reader.pages:
-                writer.add_page(page)
+        # 方法1：尝试使用pikepdf（qpdf）重新压缩数据流
+        if pikepdf is not None:
+            with pikepdf.open(file_path) as pdf:
+                pdf.save(output_path,
+                        compress_streams=True,
+                        object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                        stream_decode_level=pikepdf.StreamDecodeLevel.generalized,
+                        recompress_flate=True)
             
-            # 写入文件
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
-            
-            logger.info('使用PyPDF2压缩PDF')
-            
-        except ImportError:
-            logger.warning('PyPDF2未安装，使用备用方案')
-            import shutil
+            logger.info('使用pikepdf压缩PDF')
+        else:
+            logger.warning('pikepdf未安装，使用备用方案')
             shutil.copy2(file_path, output_path)
         
         # 检查是否达到目标大小
@@ -134,12 +221,12 @@ def compress_pdf_extreme(file_path, level, target_size_mb, tmp_dir):
         target_bytes = target_size_mb * 1024 * 1024
         
         if target_size_mb > 0 and compressed_size > target_bytes:
-            logger.info(f'需要更强制压缩，当前大小: {compressed_size/1024/1024:.2f}MB')
+            logger.info('需要更强制压缩，当前大小: %.2fMB', compressed_size / 1024 / 1024)
             
             # 方法2：转换为图片再转回PDF（极限压缩）
             try:
-                from pdf2image import convert_from_path
-                import img2pdf
+                if pdfium is None or img2pdf is None:
+                    raise ImportError('pypdfium2或img2pdf未安装')
                 
                 logger.info('使用图片转换进行PDF极限压缩...')
                 
@@ -148,53 +235,57 @@ def compress_pdf_extreme(file_path, level, target_size_mb, tmp_dir):
                 if level == 'extreme':
                     dpi = 50  # 极限压缩用50DPI
                 
-                # 将PDF转换为图片
-                images = convert_from_path(file_path, dpi=dpi)
-                
-                image_paths = []
-                for i, image in enumerate(images):
-                    img_path = os.path.join(tmp_dir, f'page_{i}.jpg')
-                    
-                    # 极低质量
-                    quality = 20 if level == 'extreme' else 40
-                    
-                    # 转换为RGB
-                    if image.mode in ('RGBA', 'LA', 'P'):
-                        image = image.convert('RGB')
-                    
-                    # 调整尺寸（如果需要）
-                    max_width = 800 if level == 'extreme' else 1200
-                    if image.width > max_width:
-                        ratio = max_width / image.width
-                        new_height = int(image.height * ratio)
-                        image = image.resize((max_width, new_height), Image.Resampling.LANCZOS)
-                    
-                    # 保存为极低质量JPEG
-                    image.save(img_path, 'JPEG', quality=quality, optimize=True, progressive=True)
-                    image_paths.append(img_path)
+                # 用PDFium在进程内逐页渲染，不需要启动pdftoppm
+                pdf = pdfium.PdfDocument(file_path)
+                try:
+                    # 渲染在主线程依次进行，缩放和JPEG编码放到线程池中与下一页渲染重叠
+                    with ThreadPoolExecutor(max_workers=max(1, min(4, len(pdf)))) as executor:
+                        futures = [executor.submit(encode_pdf_page, page.render(scale=dpi / 72).to_pil(), level)
+                                   for page in pdf]
+                    page_images = [future.result() for future in futures]
+                finally:
+                    pdf.close()
                 
                 # 将图片转换回PDF
                 pdf_output = os.path.join(tmp_dir, 'compressed_via_images.pdf')
                 with open(pdf_output, 'wb') as f:
-                    f.write(img2pdf.convert(image_paths))
+                    f.write(img2pdf.convert(page_images))
                 
                 # 检查最终大小
                 final_size = os.path.getsize(pdf_output)
                 if final_size < compressed_size:
                     output_path = pdf_output
-                    logger.info(f'图片转换压缩成功，最终大小: {final_size/1024/1024:.2f}MB')
+                    logger.info('图片转换压缩成功，最终大小: %.2fMB', final_size / 1024 / 1024)
                     
             except Exception as img_error:
-                logger.warning(f'图片转换失败: {img_error}')
+                logger.warning('图片转换失败: %s', img_error)
         
         return output_path
         
     except Exception as e:
-        logger.error(f'PDF压缩失败: {str(e)}')
-        import shutil
+        logger.error('PDF压缩失败: %s', e)
         shutil.copy2(file_path, output_path)
         return output_path
 
+def encode_pdf_page(image, level):
+    """缩小并编码PDF单页图片，返回JPEG字节"""
+    # 极低质量
+    quality = 20 if level == 'extreme' else 40
+    
+    # 转换为RGB
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGB')
+    
+    # 调整尺寸（如果需要）
+    max_width = 800 if level == 'extreme' else 1200
+    if image.width > max_width:
+        ratio = max_width / image.width
+        new_height = int(image.height * ratio)
+        image = image.resize((max_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
+    # 在内存中编码为极低质量JPEG，不落盘
+    return encode_jpeg(image, quality).getvalue()
+
 def compress_image_extreme(file_path, level, target_size_mb, tmp_dir):
     """图片极限压缩"""
     file_ext = Path(file_path).suffix.lower()
@@ -204,7 +295,7 @@ def compress_image_extreme(file_path, level, target_size_mb, tmp_dir):
         with Image.open(file_path) as img:
             # 原始信息
             original_width, original_height = img.size
-            logger.info(f'原始图片尺寸: {original_width}x{original_height}')
+            logger.info('原始图片尺寸: %dx%d', original_width, original_height)
             
             # 根据压缩级别设置参数
             if level == 'extreme':
@@ -220,62 +311,123 @@ def compress_image_extreme(file_path, level, target_size_mb, tmp_dir):
                 max_width = 1600 # 最大宽度1600px
                 format = 'JPEG' if file_ext in ['.jpg', '.jpeg'] else img.format
             
+            # JPEG大幅缩小时让解码器直接按1/2、1/4、1/8比例做IDCT
+            if img.format == 'JPEG' and img.width > max_width:
+                draft_height = int(img.height * max_width / img.width)
+                img.draft('RGB', (max_width * 2, draft_height * 2))
+            
             # 调整尺寸
             if img.width > max_width:
                 ratio = max_width / img.width
                 new_height = int(img.height * ratio)
-                img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-                logger.info(f'调整后尺寸: {max_width}x{new_height}')
+                img = img.resize((max_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+                logger.info('调整后尺寸: %dx%d', max_width, new_height)
             
             # 转换为RGB（如果需要）
             if img.mode in ('RGBA', 'LA', 'P'):
                 img = img.convert('RGB')
-                output_path = output_path.replace(file_ext, '.jpg')
+                output_path = os.path.join(tmp_dir, 'compressed.jpg')
             
-            # 保存压缩后的图片
+            # 在内存中编码，最终结果只写一次磁盘；极限压缩追求体积，用jpegli
+            jpegli = level == 'extreme'
             if format == 'JPEG':
-                img.save(output_path, 'JPEG', 
-                        quality=quality, 
-                        optimize=True, 
-                        progressive=True)
+                buf = encode_jpeg(img, quality, jpegli)
             else:
-                img.save(output_path, format, optimize=True)
+                buf = None
+                if format == 'PNG' and oxipng is not None:
+                    buf = optimize_png(img)
+                if buf is None:
+                    buf = io.BytesIO()
+                    img.save(buf, format, optimize=True)
             
-            logger.info(f'图片压缩完成，质量: {quality}%')
+            logger.info('图片压缩完成，质量: %d%%', quality)
             
             # 如果指定了目标大小，尝试进一步压缩
-            if target_size_mb > 0:
-                current_size = os.path.getsize(output_path)
+            if target_size_mb > 0 and format == 'JPEG':
+                current_size = buf.tell()
                 target_bytes = target_size_mb * 1024 * 1024
                 
-                # 逐步降低质量直到达到目标
-                while current_size > target_bytes and quality > 10:
-                    quality = max(5, quality - 10)  # 每次降低10%，最低5%
-                    
-                    with Image.open(output_path) as temp_img:
-                        temp_output = output_path.replace('.jpg', f'_q{quality}.jpg')
-                        temp_img.save(temp_output, 'JPEG', 
-                                    quality=quality, 
-                                    optimize=True)
+                # 以当前编码为一个点，再试探一个较低质量，在两点之间预测目标质量
+                low_quality = max(5, quality // 2)
+                if current_size > target_bytes and low_quality < quality:
+                    low_buf = encode_jpeg(img, low_quality, jpegli)
                     
-                    new_size = os.path.getsize(temp_output)
-                    if new_size < current_size:
-                        import shutil
-                        shutil.move(temp_output, output_path)
-                        current_size = new_size
-                        logger.info(f'进一步压缩到质量 {quality}%，大小: {current_size/1024/1024:.2f}MB')
+                    if low_buf.tell() < target_bytes:
+                        new_quality = predict_jpeg_quality(quality, current_size,
+                                                           low_quality, low_buf.tell(), target_bytes)
                     else:
-                        os.remove(temp_output)
-                        break
+                        new_quality = low_quality  # 试探结果仍超出目标，直接采用
+                    
+                    new_buf = low_buf
+                    if new_quality > low_quality:
+                        candidate = encode_jpeg(img, new_quality, jpegli)
+                        # 预测偏大导致超出目标时，退回已满足目标的试探结果
+                        if candidate.tell() <= target_bytes:
+                            new_buf = candidate
+                        else:
+                            new_quality = low_quality
+                    
+                    if new_buf.tell() < current_size:
+                        buf = new_buf
+                        quality = new_quality
+                        logger.info('进一步压缩到质量 %d%%，大小: %.2fMB', quality, buf.tell() / 1024 / 1024)
+            
+            with open(output_path, 'wb') as f:
+                f.write(buf.getbuffer())
             
             return output_path
             
     except Exception as e:
-        logger.error(f'图片压缩失败: {str(e)}')
-        import shutil
+        logger.error('图片压缩失败: %s', e)
         shutil.copy2(file_path, output_path)
         return output_path
 
+def encode_jpeg(img, quality, jpegli=False):
+    """在内存中编码JPEG，返回BytesIO；jpegli=True时优先用cjpegli换取更小的文件"""
+    if jpegli and CJPEGLI:
+        try:
+            ppm = io.BytesIO()
+            img.save(ppm, 'PPM')
+            result = subprocess.run([CJPEGLI, '/dev/stdin', '/dev/stdout', '-q', str(quality)],
+                                    input=ppm.getvalue(), capture_output=True, check=True)
+            buf = io.BytesIO(result.stdout)
+            buf.seek(0, io.SEEK_END)
+            return buf
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning('cjpegli编码失败，改用Pillow: %s', e)
+    
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buf
+
+def optimize_png(img):
+    """用oxipng压缩PNG并去掉元数据块，返回BytesIO；失败时返回None"""
+    # oxipng会重新压缩，Pillow只需快速编码
+    raw = io.BytesIO()
+    img.save(raw, 'PNG', compress_level=1)
+    try:
+        data = oxipng.optimize_from_memory(raw.getvalue(),
+                                           level=4,
+                                           strip=oxipng.StripChunks.all(),
+                                           deflate=oxipng.Deflaters.libdeflater(12))
+    except oxipng.PngError as e:
+        logger.warning('oxipng压缩失败，改用Pillow: %s', e)
+        return None
+    
+    buf = io.BytesIO(data)
+    buf.seek(0, io.SEEK_END)
+    return buf
+
+def predict_jpeg_quality(high_quality, high_size, low_quality, low_size, target_bytes):
+    """在两个已测量的点之间按 log(大小)-质量 线性插值，预测达到目标大小的质量"""
+    slope = (math.log(high_size) - math.log(low_size)) / (high_quality - low_quality)
+    if slope <= 0:
+        return low_quality
+    
+    # 向下取整，宁可略小于目标也不超出
+    quality = low_quality + (math.log(target_bytes) - math.log(low_size)) / slope
+    return int(max(low_quality, min(high_quality - 1, quality)))
+
 def compress_document_extreme(file_path, level, target_size_mb, tmp_dir):
     """文档极限压缩"""
     output_path = os.path.join(tmp_dir, 'compressed.zip')
@@ -302,6 +454,43 @@ def compress_generic_extreme(file_path, level, target_size_mb, tmp_dir):
     
     return output_path
 
+# 扩展名 -> 压缩方法
+_DISPATCH = {
+    '.pdf': compress_pdf_extreme,
+    '.jpg': compress_image_extreme,
+    '.jpeg': compress_image_extreme,
+    '.png': compress_image_extreme,
+    '.gif': compress_image_extreme,
+    '.bmp': compress_image_extreme,
+    '.webp': compress_image_extreme,
+    '.doc': compress_document_extreme,
+    '.docx': compress_document_extreme,
+    '.xls': compress_document_extreme,
+    '.xlsx': compress_document_extreme,
+    '.ppt': compress_document_extreme,
+    '.pptx': compress_document_extreme,
+}
+
+# 文件头魔数 -> 压缩方法，优先于扩展名，扩展名不对的文件也能正确处理
+_MAGIC = (
+    (b'\xff\xd8\xff', compress_image_extreme),  # JPEG
+    (b'\x89PNG', compress_image_extreme),  # PNG
+    (b'%PDF', compress_pdf_extreme),  # PDF
+)
+
+def compress_based_on_type(file_path, level, target_size_mb, tmp_dir):
+    """根据文件头和扩展名选择压缩方法"""
+    with open(file_path, 'rb') as f:
+        header = f.read(8)
+    
+    for magic, handler in _MAGIC:
+        if header.startswith(magic):
+            break
+    else:
+        handler = _DISPATCH.get(Path(file_path).suffix.lower(), compress_generic_extreme)
+    
+    return handler(file_path, level, target_size_mb, tmp_dir)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)